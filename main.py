@@ -1,8 +1,12 @@
 # main.py
 import os
+import time
 import asyncio
+import heapq
 from datetime import date
 from datetime import datetime
+from datetime import timedelta
+from zoneinfo import ZoneInfo
 from typing import List
 from fastapi import FastAPI, Request
 from fastapi.responses import HTMLResponse
@@ -15,6 +19,8 @@ from aiogram_dialog import Dialog, DialogManager, Window, setup_dialogs, StartMo
 from aiogram_dialog.widgets.kbd import (
     Calendar,
     Multiselect,
+    Radio,
+    Counter,
     Button,  # заменили Next на Button
 )
 from aiogram_dialog.widgets.text import Const, Format, Jinja, Text
@@ -47,6 +53,21 @@ WEB_SERVER_HOST = "0.0.0.0"
 WEB_SERVER_PORT = int(os.getenv("PORT", 8000))
 BASE_WEBHOOK_URL = os.getenv("RENDER_EXTERNAL_URL", "https://your-render-url.onrender.com").rstrip()
 
+# Брони старше RETENTION_DAYS переносятся из book в book_archive
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", 90))
+ARCHIVE_INTERVAL_SECONDS = int(os.getenv("ARCHIVE_INTERVAL_SECONDS", 6 * 60 * 60))
+# Окно /dashboard без фильтров: столько дней назад и всё будущее
+DASHBOARD_DEFAULT_DAYS = int(os.getenv("DASHBOARD_DEFAULT_DAYS", 30))
+
+# Принудительный пересчёт агрегатов /stats при старте
+REBUILD_STATS = os.getenv("REBUILD_STATS", "").lower() in ("1", "true", "yes")
+
+# Напоминание приходит за REMINDER_LEAD_MINUTES до слота
+REMINDER_LEAD_MINUTES = int(os.getenv("REMINDER_LEAD_MINUTES", 120))
+# Слоты бронируются по местному времени студии, а не сервера
+BOOKING_TZ = ZoneInfo(os.getenv("BOOKING_TZ", "Europe/Moscow"))
+REMINDER_BATCH_SIZE = int(os.getenv("REMINDER_BATCH_SIZE", 25))
+
 # ============= DB =============
 async def init_db():
     conn = await asyncpg.connect(DATABASE_URL)
@@ -64,8 +85,418 @@ async def init_db():
         CREATE UNIQUE INDEX IF NOT EXISTS idx_unique_booking 
         ON book (date, time)
     """)
+    # Чат для напоминаний (у старых броней его нет)
+    await conn.execute("ALTER TABLE book ADD COLUMN IF NOT EXISTS chat_id BIGINT")
+    # Архив старых броней: горячие запросы его не трогают
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS book_archive (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            date DATE NOT NULL,
+            time TEXT NOT NULL,
+            author TEXT NOT NULL,
+            archived_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    """)
+    await conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_book_archive_date
+        ON book_archive (date, time)
+    """)
+    # Агрегаты для /stats: обновляются вместе со вставкой/удалением брони.
+    # Архивирование их не трогает, так что история сохраняется.
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS book_daily_stats (
+            date DATE PRIMARY KEY,
+            hour_mask INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS book_author_daily (
+            date DATE NOT NULL,
+            author TEXT NOT NULL,
+            bookings INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (date, author)
+        )
+    """)
+    # Первый запуск или REBUILD_STATS=1: пересчитываем агрегаты с нуля
+    if REBUILD_STATS or not await conn.fetchval("SELECT EXISTS (SELECT 1 FROM book_daily_stats)"):
+        await rebuild_stats(conn)
     await conn.close()
 
+
+async def rebuild_stats(conn):
+    """Пересчёт агрегатов /stats из book и book_archive.
+
+    Лечит расхождения после записей в book в обход приложения
+    (ручной SQL, старая версия во время деплоя).
+    """
+    async with conn.transaction():
+        # SHARE блокирует вставки и удаления в book до конца пересчёта,
+        # чтобы их дельты легли уже на новые агрегаты
+        await conn.execute("LOCK TABLE book IN SHARE MODE")
+        await conn.execute("TRUNCATE book_daily_stats, book_author_daily")
+        await conn.execute("""
+            INSERT INTO book_daily_stats (date, hour_mask)
+            SELECT date, bit_or(1 << split_part(time, ':', 1)::int)
+            FROM (SELECT date, time FROM book
+                  UNION ALL SELECT date, time FROM book_archive) AS b
+            GROUP BY date
+        """)
+        await conn.execute("""
+            INSERT INTO book_author_daily (date, author, bookings)
+            SELECT date, author, count(*)
+            FROM (SELECT date, author FROM book
+                  UNION ALL SELECT date, author FROM book_archive) AS b
+            GROUP BY date, author
+        """)
+
+# ============= QUERY REGISTRY =============
+# Все SQL бронирований живут здесь: каждый запрос готовится один раз
+# на соединение пула, а не парсится заново при каждом вызове.
+QUERIES = {
+    "free_slots": "SELECT time FROM book WHERE date = $1",
+    # Все кандидаты (date, time) одним запросом: занятые слоты пропускаются
+    # уникальным индексом, вставленные возвращаются, агрегаты /stats
+    # обновляются в том же запросе. ORDER BY в upsert'ах задаёт один
+    # порядок блокировок строк, чтобы пересекающиеся повторы не ловили deadlock
+    "insert_bookings": """
+        WITH inserted AS (
+            INSERT INTO book (name, date, time, author, chat_id)
+            SELECT $1, c.date, c.time, $2, $5
+            FROM unnest($3::date[], $4::text[]) AS c(date, time)
+            ON CONFLICT (date, time) DO NOTHING
+            RETURNING id, date, time, author
+        ), hours AS (
+            INSERT INTO book_daily_stats (date, hour_mask)
+            SELECT date, bit_or(1 << split_part(time, ':', 1)::int)
+            FROM inserted
+            GROUP BY date
+            ORDER BY date
+            ON CONFLICT (date) DO UPDATE
+            SET hour_mask = book_daily_stats.hour_mask | EXCLUDED.hour_mask
+        ), authors AS (
+            INSERT INTO book_author_daily (date, author, bookings)
+            SELECT date, author, count(*)
+            FROM inserted
+            GROUP BY date, author
+            ORDER BY date, author
+            ON CONFLICT (date, author) DO UPDATE
+            SET bookings = book_author_daily.bookings + EXCLUDED.bookings
+        )
+        SELECT id, date, time FROM inserted
+    """,
+    # Границы необязательны: NULL означает «без ограничения»
+    "list_bookings": """
+        SELECT date, time, author, id
+        FROM book
+        WHERE ($1::date IS NULL OR date >= $1)
+          AND ($2::date IS NULL OR date <= $2)
+        ORDER BY date, time
+    """,
+    # Явный запрос по диапазону, захватывающему архив
+    "list_bookings_with_archive": """
+        SELECT date, time, author, id, FALSE AS archived
+        FROM book
+        WHERE ($1::date IS NULL OR date >= $1)
+          AND ($2::date IS NULL OR date <= $2)
+        UNION ALL
+        SELECT date, time, author, id, TRUE AS archived
+        FROM book_archive
+        WHERE ($1::date IS NULL OR date >= $1)
+          AND ($2::date IS NULL OR date <= $2)
+        ORDER BY date, time
+    """,
+    "archive_bookings": """
+        WITH moved AS (
+            DELETE FROM book WHERE date < $1
+            RETURNING id, name, date, time, author
+        ), archived AS (
+            INSERT INTO book_archive (id, name, date, time, author)
+            SELECT id, name, date, time, author FROM moved
+            RETURNING 1
+        )
+        SELECT count(*) FROM archived
+    """,
+    "delete_booking": """
+        WITH deleted AS (
+            DELETE FROM book WHERE id = $1
+            RETURNING id, date, time, author
+        ), hours AS (
+            UPDATE book_daily_stats s
+            SET hour_mask = s.hour_mask & ~(1 << split_part(d.time, ':', 1)::int)
+            FROM deleted d
+            WHERE s.date = d.date
+        ), authors AS (
+            UPDATE book_author_daily a
+            SET bookings = a.bookings - 1
+            FROM deleted d
+            WHERE a.date = d.date AND a.author = d.author
+        )
+        SELECT id FROM deleted
+    """,
+    "stats_hours": """
+        SELECT date, hour_mask
+        FROM book_daily_stats
+        WHERE hour_mask <> 0
+          AND ($1::date IS NULL OR date >= $1)
+          AND ($2::date IS NULL OR date <= $2)
+    """,
+    "stats_authors": """
+        SELECT author, sum(bookings)::int AS bookings
+        FROM book_author_daily
+        WHERE ($1::date IS NULL OR date >= $1)
+          AND ($2::date IS NULL OR date <= $2)
+        GROUP BY author
+        HAVING sum(bookings) > 0
+        ORDER BY bookings DESC, author
+    """,
+    "upcoming_reminders": """
+        SELECT id, date, time, chat_id
+        FROM book
+        WHERE chat_id IS NOT NULL AND date >= $1
+    """,
+}
+
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 1))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 5))
+
+db_pool = None
+
+
+class QueryStats:
+    """Счётчики вызовов и суммарное время по каждому запросу."""
+
+    def __init__(self):
+        self.calls = {}
+        self.total = {}
+        self.max = {}
+
+    def record(self, name: str, elapsed: float):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        self.total[name] = self.total.get(name, 0.0) + elapsed
+        self.max[name] = max(self.max.get(name, 0.0), elapsed)
+
+    def snapshot(self) -> dict:
+        return {
+            name: {
+                "calls": calls,
+                "total_ms": round(self.total[name] * 1000, 3),
+                "avg_ms": round(self.total[name] * 1000 / calls, 3),
+                "max_ms": round(self.max[name] * 1000, 3),
+            }
+            for name, calls in self.calls.items()
+        }
+
+
+query_stats = QueryStats()
+
+
+class BookConnection(asyncpg.Connection):
+    """Соединение пула с заранее подготовленными запросами из QUERIES."""
+
+    prepared: dict
+
+
+async def prepare_queries(conn: BookConnection):
+    # Вызывается пулом один раз для каждого нового соединения
+    conn.prepared = {name: await conn.prepare(sql) for name, sql in QUERIES.items()}
+
+
+async def create_pool():
+    return await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        connection_class=BookConnection,
+        init=prepare_queries,
+    )
+
+
+async def run_query(conn, name: str, *args, method: str = "fetch"):
+    stmt = conn.prepared[name]
+    started = time.perf_counter()
+    try:
+        return await getattr(stmt, method)(*args)
+    finally:
+        query_stats.record(name, time.perf_counter() - started)
+
+# ============= RETENTION =============
+def booking_today() -> date:
+    # «Сегодня» по времени студии, а не сервера (на Render это UTC)
+    return datetime.now(BOOKING_TZ).date()
+
+
+def retention_cutoff() -> date:
+    return booking_today() - timedelta(days=RETENTION_DAYS)
+
+
+async def archive_old_bookings() -> int:
+    # Перенос одним запросом: DELETE и INSERT в одной транзакции.
+    # Конфликт id в архиве откатит весь запрос — строки не теряются.
+    async with db_pool.acquire() as conn:
+        return await run_query(conn, "archive_bookings", retention_cutoff(), method="fetchval")
+
+
+async def archive_loop():
+    while True:
+        try:
+            moved = await archive_old_bookings()
+            if moved:
+                print(f"Archived {moved} bookings older than {retention_cutoff()}")
+        except Exception as e:
+            print(f"Archive error: {e}")
+            import traceback
+            traceback.print_exc()
+        await asyncio.sleep(ARCHIVE_INTERVAL_SECONDS)
+
+# ============= REMINDERS =============
+def slot_start(slot_date: date, slot_time: str) -> datetime:
+    return datetime.combine(slot_date, datetime.strptime(slot_time, "%H:%M").time(), tzinfo=BOOKING_TZ)
+
+
+class ReminderScheduler:
+    """Мин-куча напоминаний: спим до ближайшего, шлём пачками.
+
+    Удаление ленивое: id убирается из pending, а запись в куче
+    пропускается, когда до неё доходит очередь.
+    """
+
+    def __init__(self, lead: timedelta, batch_size: int):
+        self.lead = lead
+        self.batch_size = batch_size
+        self.heap = []  # (remind_at, booking_id, chat_id, slot)
+        self.pending = set()
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def add(self, booking_id: int, chat_id: int, slot_date: date, slot_time: str):
+        start = slot_start(slot_date, slot_time)
+        remind_at = (start - self.lead).timestamp()
+        if remind_at <= time.time() or booking_id in self.pending:
+            return
+        heapq.heappush(self.heap, (remind_at, booking_id, chat_id, f"{slot_date:%d.%m} {slot_time}"))
+        self.pending.add(booking_id)
+        # Будим цикл, только если новое напоминание стало ближайшим
+        if self.heap[0][1] == booking_id:
+            self.wakeup.set()
+
+    def cancel(self, booking_id: int):
+        self.pending.discard(booking_id)
+
+    async def load(self):
+        async with db_pool.acquire() as conn:
+            rows = await run_query(conn, "upcoming_reminders", booking_today())
+        for r in rows:
+            self.add(r["id"], r["chat_id"], r["date"], r["time"])
+        print(f"Loaded {len(self.pending)} reminders")
+
+    def start(self, bot: Bot):
+        self.task = asyncio.create_task(self.run(bot))
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    def pop_due(self) -> List[tuple]:
+        due = []
+        now = time.time()
+        while self.heap and self.heap[0][0] <= now and len(due) < self.batch_size:
+            item = heapq.heappop(self.heap)
+            if item[1] in self.pending:
+                self.pending.discard(item[1])
+                due.append(item)
+        return due
+
+    async def run(self, bot: Bot):
+        while True:
+            try:
+                await self.step(bot)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Reminder error: {e}")
+                import traceback
+                traceback.print_exc()
+                await asyncio.sleep(1)
+
+    async def step(self, bot: Bot):
+        # Отменённые записи сверху кучи не должны задавать таймаут сна
+        while self.heap and self.heap[0][1] not in self.pending:
+            heapq.heappop(self.heap)
+        timeout = self.heap[0][0] - time.time() if self.heap else None
+        if timeout is None or timeout > 0:
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            return
+        await self.send_batch(bot, self.pop_due())
+        # Telegram ограничивает ~30 сообщений в секунду
+        await asyncio.sleep(1)
+
+    async def send_batch(self, bot: Bot, due: List[tuple]):
+        # Несколько слотов одного чата — одно сообщение
+        slots_by_chat = {}
+        for _, _, chat_id, slot in due:
+            slots_by_chat.setdefault(chat_id, []).append(slot)
+        results = await asyncio.gather(
+            *(
+                bot.send_message(chat_id, "⏰ Напоминание о репетиции: " + ", ".join(slots))
+                for chat_id, slots in slots_by_chat.items()
+            ),
+            return_exceptions=True,
+        )
+        for chat_id, result in zip(slots_by_chat, results):
+            if isinstance(result, Exception):
+                print(f"Reminder error for chat {chat_id}: {result}")
+
+
+reminders = ReminderScheduler(timedelta(minutes=REMINDER_LEAD_MINUTES), REMINDER_BATCH_SIZE)
+
+# ============= STATS =============
+def hour_runs(hour_mask: int) -> List[int]:
+    """Длины подряд идущих занятых часов в маске дня."""
+    runs = []
+    length = 0
+    for hour in range(25):
+        if hour < 24 and hour_mask >> hour & 1:
+            length += 1
+        elif length:
+            runs.append(length)
+            length = 0
+    return runs
+
+
+def utilization_stats(days, date_from: date, date_to: date) -> dict:
+    heatmap = [[0] * 24 for _ in range(7)]
+    rehearsal_lengths = {}
+    for row in days:
+        weekday = row["date"].weekday()
+        for hour in range(24):
+            if row["hour_mask"] >> hour & 1:
+                heatmap[weekday][hour] += 1
+        for length in hour_runs(row["hour_mask"]):
+            rehearsal_lengths[length] = rehearsal_lengths.get(length, 0) + 1
+
+    # Сколько раз каждый день недели встречается в диапазоне —
+    # знаменатель для доли занятости слота
+    weekday_totals = [0] * 7
+    if date_from and date_to and date_from <= date_to:
+        total_days = (date_to - date_from).days + 1
+        for offset in range(min(total_days, 7)):
+            weekday = (date_from + timedelta(days=offset)).weekday()
+            weekday_totals[weekday] = (total_days - offset + 6) // 7
+    utilization = [
+        [round(count / weekday_totals[weekday], 3) if weekday_totals[weekday] else 0.0 for count in hours]
+        for weekday, hours in enumerate(heatmap)
+    ]
+    return {
+        "heatmap": heatmap,
+        "utilization": utilization,
+        "rehearsal_lengths": dict(sorted(rehearsal_lengths.items())),
+    }
+
 # ============= CALENDAR WIDGETS =============
 SELECTED_DAYS_KEY = "selected_dates"
 
@@ -117,6 +548,29 @@ class CustomCalendar(Calendar):
             ),
         }
 
+# ============= RECURRENCE =============
+# (подпись, id, шаг в днях)
+REPEAT_MODES = [
+    ("Один раз", "once", 0),
+    ("Каждую неделю", "weekly", 7),
+    ("Раз в две недели", "biweekly", 14),
+]
+REPEAT_STEP_DAYS = {mode_id: step for _, mode_id, step in REPEAT_MODES}
+MAX_OCCURRENCES = 12
+
+
+def expand_occurrences(start: date, mode: str, occurrences: int) -> List[date]:
+    step = REPEAT_STEP_DAYS.get(mode, 0)
+    if not step:
+        return [start]
+    return [start + timedelta(days=step * i) for i in range(occurrences)]
+
+
+def is_recurring(data, widget, manager: DialogManager) -> bool:
+    # Счётчик повторов показываем только при выбранном повторе
+    repeat = manager.find("r_repeat")
+    return bool(repeat and REPEAT_STEP_DAYS.get(repeat.get_checked()))
+
 # ============= STATES =============
 class MySG(StatesGroup):
     window1 = State()
@@ -144,19 +598,18 @@ async def get_time(dialog_manager: DialogManager, event_from_user, **kwargs):
     print(f"Selected date string: {selected_date_str}")
     
     if not selected_date_str:
-        return {"time_slots": [], "time_slots2": [], "count": 0, "count2": 0}
+        return {"time_slots": [], "time_slots2": [], "count": 0, "count2": 0, "repeat_modes": REPEAT_MODES}
     
     try:
         selected_date = date.fromisoformat(selected_date_str)
         print(f"Parsed date: {selected_date}")
     except ValueError as e:
         print(f"Date parsing error: {e}")
-        return {"time_slots": [], "time_slots2": [], "count": 0, "count2": 0}
+        return {"time_slots": [], "time_slots2": [], "count": 0, "count2": 0, "repeat_modes": REPEAT_MODES}
 
-    conn = await asyncpg.connect(DATABASE_URL)
-    rows = await conn.fetch("SELECT time FROM book WHERE date = $1", selected_date)  # ✅ объект date
+    async with db_pool.acquire() as conn:
+        rows = await run_query(conn, "free_slots", selected_date)  # ✅ объект date
     booked_times = {row["time"] for row in rows}
-    await conn.close()
 
     time_slots_zero1 = ["8:00", "9:00", "10:00", "11:00", "12:00", "13:00", "14:00", "15:00"]
     time_slots_zero2 = ["16:00", "17:00", "18:00", "19:00", "20:00", "21:00", "22:00", "23:00"]
@@ -169,14 +622,13 @@ async def get_time(dialog_manager: DialogManager, event_from_user, **kwargs):
         "time_slots2": time_slots2,
         "count": len(time_slots),
         "count2": len(time_slots2),
+        "repeat_modes": REPEAT_MODES,
     }
     print(f"Time slots result: {result}")
     return result
 
 # 🔥 НОВАЯ ФУНКЦИЯ: обработка нажатия "Забить"
 async def on_book_click(callback: CallbackQuery, button, manager: DialogManager):
-    from asyncpg import UniqueViolationError
-
     selected_date_str = manager.dialog_data.get("selected_date")
     if not selected_date_str:
         await callback.answer("❌ Не выбрана дата!", show_alert=True)
@@ -199,28 +651,54 @@ async def on_book_click(callback: CallbackQuery, button, manager: DialogManager)
         await callback.answer("❌ Выбери время!", show_alert=True)
         return
 
+    # 🔁 Повтор: разворачиваем даты и проверяем все слоты одним запросом
+    repeat = manager.find("r_repeat")
+    counter = manager.find("c_occurrences")
+    mode = (repeat.get_checked() if repeat else None) or "once"
+    occurrences = int(counter.get_value()) if counter else 1
+    dates = expand_occurrences(selected_date, mode, occurrences)
+
+    # Прошедшие даты не бронируем: старые слоты уже могли уйти в архив,
+    # где нет уникального индекса, и получился бы дубль
+    if min(dates) < booking_today():
+        await callback.answer("❌ Нельзя забронировать прошедшую дату!", show_alert=True)
+        return
+    candidates = [(d, t) for d in dates for t in checked]
+
     author = callback.from_user.username or f"user_{callback.from_user.id}"
     name = author
+    # Напоминание придёт в тот чат, где делали бронь (в т.ч. в группу)
+    chat_id = callback.message.chat.id if callback.message else callback.from_user.id
 
-    conn = await asyncpg.connect(DATABASE_URL)
     try:
-        for t in checked:
-            # ✅ Передаём объект date, а не строку
-            await conn.execute(
-                "INSERT INTO book (name, date, time, author) VALUES ($1, $2, $3, $4)",
-                name, selected_date, t, author
+        async with db_pool.acquire() as conn:
+            # ✅ Передаём объекты date, а не строки
+            rows = await run_query(
+                conn, "insert_bookings", name, author,
+                [d for d, _ in candidates], [t for _, t in candidates], chat_id,
             )
-        # Сохраняем для финального экрана
-        manager.dialog_data.update({
-            "final_date": selected_date.isoformat(),
-            "final_times": checked,
-            "final_author": author
-        })
-        await manager.next()
-    except UniqueViolationError:
+    except asyncpg.PostgresError as e:
+        print(f"Booking error: {e}")
+        await callback.answer("⚠️ Не удалось забронировать, попробуй ещё раз.", show_alert=True)
+        return
+    booked = {(r["date"], r["time"]) for r in rows}
+    for r in rows:
+        reminders.add(r["id"], chat_id, r["date"], r["time"])
+    conflicts = [(d, t) for d, t in candidates if (d, t) not in booked]
+
+    if not booked:
         await callback.answer("⚠️ Слот уже занят! Выбери другое время.", show_alert=True)
-    finally:
-        await conn.close()
+        return
+
+    # Сохраняем для финального экрана
+    manager.dialog_data.update({
+        "final_date": selected_date.isoformat(),
+        "final_dates": sorted({d.isoformat() for d, _ in booked}),
+        "final_times": checked,
+        "final_conflicts": [f"{d.isoformat()} {t}" for d, t in conflicts],
+        "final_author": author
+    })
+    await manager.next()
 
 # 🔥 НОВАЯ ФУНКЦИЯ: только отображение результата (без записи в БД!)
 async def final_getter(dialog_manager: DialogManager, **kwargs):
@@ -229,6 +707,8 @@ async def final_getter(dialog_manager: DialogManager, **kwargs):
         "date": data.get("final_date", "—"),
         "author_user": data.get("final_author", "—"),
         "times": ", ".join(data.get("final_times", [])) or "—",
+        "dates": ", ".join(data.get("final_dates", [])) or "—",
+        "conflicts": ", ".join(data.get("final_conflicts", [])),
     }
 
 # ============= DIALOG =============
@@ -242,6 +722,7 @@ dialog = Dialog(
         Const("Сначала выбери дату. Просто нажми на нужное число"),
         Const("Затем в нижней части выбери время. Можно несколько слотов"),
         Const("Когда дата нажата и галочки на нужное время стоят, то смело жми Забить!"),
+        Const("Для репетиций по расписанию выбери повтор и число раз — занятые даты пропустим"),
         CustomCalendar(id="cal", on_click=win1_on_date_selected),
         Multiselect(
             Format("✓ {item[0]}"),
@@ -257,6 +738,21 @@ dialog = Dialog(
             item_id_getter=operator.itemgetter(1),
             items="time_slots2",
         ),
+        Radio(
+            Format("🔘 {item[0]}"),
+            Format("⚪️ {item[0]}"),
+            id="r_repeat",
+            item_id_getter=operator.itemgetter(1),
+            items="repeat_modes",
+        ),
+        Counter(
+            id="c_occurrences",
+            text=Format("Повторов: {value:g}"),
+            min_value=1,
+            max_value=MAX_OCCURRENCES,
+            default=1,
+            when=is_recurring,
+        ),
         # 🔥 ЗАМЕНА: Next → Button с обработчиком
         Button(Const("Забить"), id="book_btn", on_click=on_book_click),
         getter=get_time,
@@ -266,8 +762,10 @@ dialog = Dialog(
         Const("✅ Время забронировано"),
         Jinja(
             "<b>Дата</b>: {{date}}\n"
+            "<b>Даты</b>: {{dates}}\n"
             "<b>Время</b>: {{times}}\n"
             "<b>Автор</b>: {{author_user}}\n"
+            "{% if conflicts %}<b>⚠️ Уже заняты</b>: {{conflicts}}\n{% endif %}"
         ),
         state=MySG.window3,
         getter=final_getter,  # 🔥 новая функция без записи в БД
@@ -286,7 +784,12 @@ setup_dialogs(dp)
 
 @app.on_event("startup")
 async def on_startup():
+    global db_pool
     await init_db()
+    db_pool = await create_pool()
+    app.state.archive_task = asyncio.create_task(archive_loop())
+    await reminders.load()
+    reminders.start(bot)
     webhook_url = f"{BASE_WEBHOOK_URL}{WEBHOOK_PATH}"
     await bot.set_webhook(
         url=webhook_url,
@@ -294,6 +797,15 @@ async def on_startup():
         drop_pending_updates=True
     )
 
+@app.on_event("shutdown")
+async def on_shutdown():
+    archive_task = getattr(app.state, "archive_task", None)
+    if archive_task is not None:
+        archive_task.cancel()
+    reminders.stop()
+    if db_pool is not None:
+        await db_pool.close()
+
 @app.post(WEBHOOK_PATH)
 async def bot_webhook(request: Request):
     try:
@@ -311,8 +823,6 @@ async def bot_webhook(request: Request):
 
 @app.get("/dashboard")
 async def dashboard(request: Request):
-    from datetime import datetime, timedelta
-    
     # Получаем параметры фильтрации
     date_from_str = request.query_params.get("date_from")
     date_to_str = request.query_params.get("date_to")
@@ -333,38 +843,22 @@ async def dashboard(request: Request):
         except ValueError:
             pass
     
-    conn = await asyncpg.connect(DATABASE_URL)
-    
-    # Формируем запрос с фильтрацией
-    if date_from and date_to:
-        rows = await conn.fetch("""
-            SELECT date, time, author, id 
-            FROM book 
-            WHERE date >= $1 AND date <= $2 
-            ORDER BY date, time
-        """, date_from, date_to)
-    elif date_from:
-        rows = await conn.fetch("""
-            SELECT date, time, author, id 
-            FROM book 
-            WHERE date >= $1 
-            ORDER BY date, time
-        """, date_from)
-    elif date_to:
-        rows = await conn.fetch("""
-            SELECT date, time, author, id 
-            FROM book 
-            WHERE date <= $1 
-            ORDER BY date, time
-        """, date_to)
-    else:
-        rows = await conn.fetch("SELECT date, time, author, id FROM book ORDER BY date, time")
-    
-    await conn.close()
+    # Без фильтров показываем только недавнее окно, а не всю историю
+    if date_from is None and date_to is None:
+        date_from = booking_today() - timedelta(days=DASHBOARD_DEFAULT_DAYS)
+        date_from_str = date_from.isoformat()
+
+    # Архив читаем только если диапазон явно уходит за границу хранения
+    reaches_archive = date_from is None or date_from < retention_cutoff()
+    query_name = "list_bookings_with_archive" if reaches_archive else "list_bookings"
+
+    # Один подготовленный запрос: пустые границы передаются как NULL
+    async with db_pool.acquire() as conn:
+        rows = await run_query(conn, query_name, date_from, date_to)
 
     # Подсчет статистики
     total_bookings = len(rows)
-    today = date.today()
+    today = booking_today()
     today_bookings = len([r for r in rows if r['date'] == today])
     
     # Группировка по датам и поиск репетиций
@@ -664,6 +1158,14 @@ async def dashboard(request: Request):
                 is_rehearsal = booking['id'] in rehearsal_ids
                 row_class = "rehearsal-row" if is_rehearsal else ""
                 rehearsal_text = '<span class="rehearsal-indicator">🎭 Репетиция</span>' if is_rehearsal else '<span style="color: #6c757d; font-size: 0.9em;">Обычный слот</span>'
+
+                # Архивные брони только для просмотра
+                if booking.get('archived'):
+                    action_html = '<span style="color: #6c757d; font-size: 0.9em;">🗄 В архиве</span>'
+                else:
+                    action_html = f'''<button class="delete-btn" onclick="deleteBooking({booking['id']})">
+                                ❌ Удалить
+                            </button>'''
                 
                 html += f'''
                     <tr class="{row_class}">
@@ -677,9 +1179,7 @@ async def dashboard(request: Request):
                             {rehearsal_text}
                         </td>
                         <td>
-                            <button class="delete-btn" onclick="deleteBooking({booking['id']})">
-                                ❌ Удалить
-                            </button>
+                            {action_html}
                         </td>
                     </tr>
                 '''
@@ -726,22 +1226,56 @@ async def dashboard(request: Request):
 # Исправленный endpoint для удаления бронирований (без двойных скобок)
 @app.post("/delete_booking/{booking_id}")
 async def delete_booking(booking_id: int):
-    conn = await asyncpg.connect(DATABASE_URL)
+    async with db_pool.acquire() as conn:
+        deleted_id = await run_query(conn, "delete_booking", booking_id, method="fetchval")
+    if deleted_id is not None:
+        reminders.cancel(deleted_id)
+        return {"status": "success", "message": "Бронирование удалено"}
+    else:
+        return {"status": "error", "message": "Бронирование не найдено"}
+
+@app.get("/query_stats")
+async def get_query_stats():
+    return query_stats.snapshot()
+
+@app.get("/stats")
+async def stats(request: Request):
+    date_from = None
+    date_to = None
     try:
-        result = await conn.execute("DELETE FROM book WHERE id = $1", booking_id)
-        if result == "DELETE 1":
-            return {"status": "success", "message": "Бронирование удалено"}
-        else:
-            return {"status": "error", "message": "Бронирование не найдено"}
-    finally:
-        await conn.close()
+        if request.query_params.get("date_from"):
+            date_from = date.fromisoformat(request.query_params["date_from"])
+        if request.query_params.get("date_to"):
+            date_to = date.fromisoformat(request.query_params["date_to"])
+    except ValueError:
+        return {"error": "Даты в формате YYYY-MM-DD"}
+
+    # Как и /dashboard: без фильтров — недавнее окно
+    if date_from is None and date_to is None:
+        date_from = booking_today() - timedelta(days=DASHBOARD_DEFAULT_DAYS)
+
+    async with db_pool.acquire() as conn:
+        days = await run_query(conn, "stats_hours", date_from, date_to)
+        authors = await run_query(conn, "stats_authors", date_from, date_to)
+
+    # Открытые границы закрываем по фактическим данным
+    range_from = date_from or min((r["date"] for r in days), default=None)
+    range_to = date_to or max((r["date"] for r in days), default=None)
+
+    return {
+        "date_from": range_from.isoformat() if range_from else None,
+        "date_to": range_to.isoformat() if range_to else None,
+        "weekdays": ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"],
+        **utilization_stats(days, range_from, range_to),
+        "authors": {r["author"]: r["bookings"] for r in authors},
+    }
 
 
 
 
 @app.get("/")
 async def root():
-    return {"status": "OK", "dashboard": "/dashboard"}
+    return {"status": "OK", "dashboard": "/dashboard", "stats": "/stats"}
 
 @dp.message(Command("start"))
 async def start(message: Message, dialog_manager: DialogManager):